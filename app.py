@@ -1,15 +1,24 @@
+import logging
 import os
+import queue
 import random
+import sqlite3
 import threading
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 import streamlit as st
 from st_supabase_connection import SupabaseConnection
 
+logger = logging.getLogger(__name__)
+
 # ---------------- CONFIG ----------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 AWS_URL = "https://d3b45akprxecp4.cloudfront.net/GTSD-220-test/"
 EXAMPLES_DIR = os.path.join(BASE_DIR, "examples")
+LABEL_CACHE_FILE = os.path.join(BASE_DIR, "label_cache.db")
+LABEL_CACHE_MAX_AGE = 6 * 60 * 60  # Sekunden bis zum nächsten Voll-Sync
 
 CLASSES = {
     # "okay": "**Okay / No Defect**",
@@ -40,131 +49,291 @@ st.set_page_config(
 )
 
 # ---------------- SUPABASE ----------------
-conn = st.connection("supabase", type=SupabaseConnection)
+@st.cache_resource
+def get_conn():
+    """Supabase client shared across reruns, sessions and worker threads."""
+    return st.connection("supabase", type=SupabaseConnection)
+
+
+conn = get_conn()
 TABLE_NAME = "labels"
+INSERT_BATCH_SIZE = 100
+INSERT_BATCH_WAIT = 0.25  # Sekunden
+COUNTS_VIEW = "label_counts"
+COUNTS_BATCH_SIZE = 100
+USER_RANK_RPC = "user_rank"
+
+
+def _insert_worker(q):
+    """
+    Insert queued labels, batching everything submitted in quick succession.
+    Images of failed inserts are reported back to the submitting session.
+    """
+    while True:
+        batch = [q.get()]
+        try:
+            while len(batch) < INSERT_BATCH_SIZE:
+                batch.append(q.get(timeout=INSERT_BATCH_WAIT))
+        except queue.Empty:
+            pass
+        try:
+            rows = [row for row, _ in batch]
+            conn.table(TABLE_NAME).insert(rows, count="None").execute()
+        except Exception:
+            logger.exception("Failed to insert %d labels", len(batch))
+            for row, failed in batch:
+                failed.put(row["image"])
+
+
+@st.cache_resource
+def _label_queue():
+    """Queue consumed by a single background insert worker."""
+    q = queue.Queue()
+    threading.Thread(target=_insert_worker, args=(q,), daemon=True).start()
+    return q
 
 
 def save_label_bg(user, image, label):
-    """Save label in a background thread."""
+    """Save label in the background; failures go to this session's queue."""
+    _label_queue().put(
+        (
+            {
+                "user": user,
+                "image": image,
+                "label": label,
+            },
+            st.session_state.failed_inserts,
+        )
+    )
 
-    def _save():
-        conn.table("labels").insert(
-            [
-                {
-                    "user": user,
-                    "image": image,
-                    "label": label,
-                    "timestamp": datetime.now().isoformat(),
-                }
-            ],
-            count="None",
-        ).execute()
 
-    threading.Thread(target=_save, daemon=True).start()
+PAGE_SIZE = 1000  # Supabase-Limit
+FETCH_WORKERS = 4
 
 
-@st.cache_data(ttl=120)  # Cache für 2 Minuten
-def fetch_labels():
+def _fetch_all(table, columns, order):
     """
-    Lädt alle Labels aus der Supabase-Tabelle mit Pagination.
-    Cacht das Ergebnis für 120 Sekunden.
+    Lädt alle Zeilen einer Tabelle oder View mit Pagination.
+    Die Seiten werden parallel abgefragt; `order` muss eindeutig sein,
+    damit sich die Seiten nicht überschneiden oder Zeilen auslassen.
     """
-    PAGE_SIZE = 1000  # Supabase-Limit
-    # Gesamtanzahl abfragen
-    res = conn.table(TABLE_NAME).select("id", count="exact").limit(1).execute()
+    # Geschätzte Gesamtanzahl abfragen (kein Full-Table-Scan)
+    res = conn.table(table).select(columns, count="estimated").limit(1).execute()
     total_count = res.count or 0
 
-    all_rows = []
-
-    for offset in range(0, total_count, PAGE_SIZE):
-        start = offset
+    def _page(offset):
         end = offset + PAGE_SIZE - 1
-        response = conn.table(TABLE_NAME).select("*").range(start, end).execute()
-        rows = response.data or []
-        all_rows.extend(rows)
+        query = conn.table(table).select(columns).order(order)
+        return query.range(offset, end).execute().data or []
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        pages = list(ex.map(_page, range(0, total_count, PAGE_SIZE)))
+
+    # Schätzung kann zu niedrig sein: weiterladen, solange Seiten voll sind
+    offset = len(pages) * PAGE_SIZE
+    while not pages or len(pages[-1]) == PAGE_SIZE:
+        pages.append(_page(offset))
+        offset += PAGE_SIZE
 
-    return all_rows
+    return list(chain.from_iterable(pages))
 
 
-def get_unlabeled_images(all_images):
+def _latest_label_id():
+    """Höchste Label-ID in Supabase."""
+    res = conn.table(TABLE_NAME).select("id").order("id", desc=True).limit(1).execute()
+    return res.data[0]["id"] if res.data else 0
+
+
+def _fetch_new_labels(after_id):
     """
-    Return images labeled by less than 2 users.
+    Lädt Labels mit id > after_id Seite für Seite, bis eine Seite nicht
+    mehr voll ist. Ohne Count-Abfrage: meist ist es eine leere Seite.
     """
-    rows = fetch_labels()  # gecachte Daten
+    rows = []
+    while True:
+        query = conn.table(TABLE_NAME).select("id, image").gt("id", after_id)
+        page = query.order("id").limit(PAGE_SIZE).execute().data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        after_id = page[-1]["id"]
+
+
+def _fetch_counts_for(images):
+    """Aktuelle Zählungen aus `label_counts`, nur für die angegebenen Bilder."""
+    images = sorted(images)
     counts = {}
-    for r in rows:
-        counts[r["image"]] = counts.get(r["image"], set())
-        counts[r["image"]].add(r["user"])
-    return [img for img in all_images if len(counts.get(img, set())) < 1]
+    for i in range(0, len(images), COUNTS_BATCH_SIZE):
+        batch = images[i : i + COUNTS_BATCH_SIZE]
+        res = conn.table(COUNTS_VIEW).select("image, n").in_("image", batch).execute()
+        counts.update({r["image"]: r["n"] for r in res.data or []})
+    return counts
+
+
+@st.cache_resource
+def _cache_db():
+    """Single SQLite connection for the snapshot, shared by all sessions."""
+    db = sqlite3.connect(LABEL_CACHE_FILE, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS image_counts (image TEXT PRIMARY KEY, n INTEGER);
+        """
+    )
+    # Sessions laufen in eigenen Threads: Transaktionen serialisieren
+    return db, threading.Lock()
 
 
-def get_count(min_users=1):
-    rows = fetch_labels()  # gecachte Daten
-    counts = {}
-    for r in rows:
-        counts[r["image"]] = counts.get(r["image"], set())
-        counts[r["image"]].add(r["user"])
-    if min_users == 1:
-        return sum(1 for users in counts.values() if len(users) >= 1)
-    else:
-        return sum(1 for users in counts.values() if len(users) >= min_users)
+@st.cache_data(ttl=120)  # Cache für 2 Minuten
+def _aggregated():
+    """
+    Anzahl unterschiedlicher User pro Bild, einmal pro TTL.
+    Der lokale SQLite-Snapshot wird inkrementell aktualisiert: aus Supabase
+    kommen nur neue Labels und die Zählungen der davon betroffenen Bilder.
+    Ist der letzte Voll-Sync zu alt, wird `label_counts` komplett neu
+    geladen; das erfasst auch gelöschte oder korrigierte Labels.
+    """
+    db, lock = _cache_db()
+    with lock, db:
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+    now = int(time.time())
+
+    if now - meta.get("synced_at", 0) > LABEL_CACHE_MAX_AGE:
+        max_id = _latest_label_id()
+        rows = _fetch_all(COUNTS_VIEW, "image, n", order="image")
+        img2n = {r["image"]: r["n"] for r in rows}
+        with lock, db:
+            db.execute("DELETE FROM image_counts")
+            db.executemany("INSERT INTO image_counts VALUES (?, ?)", img2n.items())
+            db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("max_id", max_id), ("synced_at", now)],
+            )
+        return img2n
+
+    new = _fetch_new_labels(meta.get("max_id", 0))
+    changed = _fetch_counts_for({r["image"] for r in new}) if new else {}
+    with lock, db:
+        if new:
+            db.executemany(
+                "INSERT OR REPLACE INTO image_counts VALUES (?, ?)", changed.items()
+            )
+            db.execute(
+                "INSERT INTO meta VALUES ('max_id', ?) ON CONFLICT(key) "
+                "DO UPDATE SET value = MAX(value, excluded.value)",
+                (new[-1]["id"],),
+            )
+        return dict(db.execute("SELECT image, n FROM image_counts"))
+
+
+def _drop_failed_submissions():
+    """Forget submitted images whose insert failed, so they are offered again."""
+    failed = st.session_state.failed_inserts
+    lost = 0
+    while not failed.empty():
+        st.session_state.submitted.discard(failed.get_nowait())
+        lost += 1
+    if lost:
+        st.toast(f"⚠️ {lost} label(s) could not be saved and will be asked again.")
+
+
+def _image_counts():
+    """
+    Distinct users per image, including images submitted in this session
+    that may not have reached Supabase or the cached snapshot yet.
+    """
+    img2n = _aggregated()  # gecachte Daten
+    # Optimistisch: Bilder ohne Server-Label zählen nach Submit als 1
+    pending = [img for img in st.session_state.submitted if img not in img2n]
+    if pending:
+        img2n = {**img2n, **dict.fromkeys(pending, 1)}
+    return img2n
 
 
-def get_stats_per_user(user_name):
-    rows = fetch_labels()  # gecachte Daten
-    user_labels = [r for r in rows if r["user"] == user_name]
-    total_labeled = len(user_labels)
-    # Rang berechnen
-    user_counts = {}
-    for r in rows:
-        user_counts[r["user"]] = user_counts.get(r["user"], 0) + 1
-    sorted_counts = sorted(user_counts.items(), key=lambda x: x[1], reverse=True)
-    rank = next(
-        (i + 1 for i, (u, _) in enumerate(sorted_counts) if u == user_name), None
-    )
+def get_unlabeled_images(all_images, min_users=1):
+    """
+    Return images labeled by less than `min_users` users.
+    """
+    img2n = _image_counts()
+    done = {img for img, n in img2n.items() if n >= min_users}
+    return [img for img in all_images if img not in done]
+
 
-    return total_labeled, rank
+def progress_counts():
+    """Number of images labeled by at least 1 and at least 2 users."""
+    n1 = n2 = 0
+    for n in _image_counts().values():
+        if n >= 1:
+            n1 += 1
+        if n >= 2:
+            n2 += 1
+    return n1, n2
+
+
+@st.cache_data(ttl=60)
+def get_stats_per_user(user_name):
+    """Label count and leaderboard rank, computed in Postgres."""
+    rows = conn.rpc(USER_RANK_RPC, {"uname": user_name}).execute().data
+    if not rows:
+        return 0, None
+    return rows[0]["total"], rows[0]["rnk"]
 
 
 # ---------------- UTILS ----------------
 @st.cache_data
 def load_images_list():
-    image_paths = []
     test_file = os.path.join(BASE_DIR, "test.txt")
 
     if not os.path.exists(test_file):
         st.error(f"File not found: {test_file}")
-        return []
+        return ()
 
     with open(test_file, "r") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                image_paths.append(line)
+        return tuple(line for line in map(str.strip, f) if line)
+
 
-    return image_paths
+@st.cache_data
+def _list_example_images(class_path):
+    with os.scandir(class_path) as entries:
+        return [
+            e.name
+            for e in entries
+            if e.name.lower().endswith((".jpg", ".png", ".jpeg")) and e.is_file()
+        ]
+
+
+def _sample_example_images():
+    """Pick up to 4 example images per class; drawn once per session."""
+    samples = {}
+    for class_key in CLASSES:
+        class_path = os.path.join(EXAMPLES_DIR, class_key)
+        if os.path.isdir(class_path):
+            images = _list_example_images(class_path)
+            samples[class_key] = st.session_state.rng.sample(
+                images, min(4, len(images))
+            )
+    return samples
 
 
 def show_example_images():
+    if "example_samples" not in st.session_state:
+        st.session_state.example_samples = _sample_example_images()
+
     with st.expander("ℹ️ Example images per defect class"):
-        for class_key, class_label in CLASSES.items():
+        for class_key, sample_images in st.session_state.example_samples.items():
             class_path = os.path.join(EXAMPLES_DIR, class_key)
-            if os.path.isdir(class_path):
-                st.markdown(f"**{class_label}**")
-                st.caption(CLASS_EXPLANATIONS[class_key])
-                images = [
-                    f
-                    for f in os.listdir(class_path)
-                    if f.lower().endswith((".jpg", ".png", ".jpeg"))
-                ]
-                sample_images = random.sample(images, min(4, len(images)))
-                cols = st.columns(len(sample_images))
-                for col, img_file in zip(cols, sample_images):
-                    col.image(os.path.join(class_path, img_file), width="stretch")
+            st.markdown(f"**{CLASSES[class_key]}**")
+            st.caption(CLASS_EXPLANATIONS[class_key])
+            cols = st.columns(len(sample_images))
+            for col, img_file in zip(cols, sample_images):
+                col.image(os.path.join(class_path, img_file), width="stretch")
 
 
 def select_random_image(unlabeled):
-    return random.choice(unlabeled) if unlabeled else None
+    return st.session_state.rng.choice(unlabeled) if unlabeled else None
 
 
 # ---------------- SESSION ----------------
@@ -172,26 +341,34 @@ if "user" not in st.session_state:
     st.session_state.user = None
 if "current_image" not in st.session_state:
     st.session_state.current_image = None
+if "next_image" not in st.session_state:
+    st.session_state.next_image = None
+if "submitted" not in st.session_state:
+    st.session_state.submitted = set()
+if "failed_inserts" not in st.session_state:
+    # Vom Insert-Worker befüllt, threadsicher
+    st.session_state.failed_inserts = queue.SimpleQueue()
+if "rng" not in st.session_state:
+    st.session_state.rng = random.Random()
 
 stats = {"total_labeled": 0, "rank": 0}
 
 # ---------------- UI ----------------
-markdown_text = """
+INTRO_TEXT = """
     Help improve traffic sign recognition!<br>
     Select the type of defect for each street sign image and click <b>Submit</b>.<br>
     """
 
+st.title("🚦 Street Sign Conditions")
+st.markdown(INTRO_TEXT, unsafe_allow_html=True)
+
 if "user" in st.session_state and st.session_state.user:
     user = st.session_state.user
     total_labeled, rank = get_stats_per_user(user)
     stats["total_labeled"] = total_labeled
     stats["rank"] = rank
 
-    markdown_text += f"👋 Hello **{user}** — 🏅 Rank: **{rank}**"
-
-
-st.title("🚦 Street Sign Conditions")
-st.markdown(markdown_text, unsafe_allow_html=True)
+    st.markdown(f"👋 Hello **{user}** — 🏅 Rank: **{rank}**")
 
 # --- Examples ---
 # if st.session_state.user is None:
@@ -213,8 +390,9 @@ if st.session_state.user is None:
 
 
 # --- Main labeling ---
-if st.session_state.user:
-    all_images = load_images_list()
+@st.fragment
+def labeling_panel(all_images):
+    _drop_failed_submissions()
     unlabeled = get_unlabeled_images(all_images)
 
     if not unlabeled:
@@ -227,31 +405,30 @@ if st.session_state.user:
         img_path = st.session_state.current_image
         col_img, col_labels = st.columns([5, 3], gap="large")
 
+        # Nächstes Bild neu wählen, falls es inzwischen gelabelt wurde
+        if st.session_state.next_image not in set(unlabeled) - {img_path}:
+            st.session_state.next_image = select_random_image(
+                [img for img in unlabeled if img != img_path]
+            )
+
         with col_img:
             st.image(AWS_URL + img_path, width="stretch")
+            # Nächstes Bild schon jetzt vom CDN laden (unsichtbar)
+            if st.session_state.next_image:
+                next_url = AWS_URL + st.session_state.next_image
+                st.markdown(
+                    f'<img src="{next_url}" style="display:none">',
+                    unsafe_allow_html=True,
+                )
 
         with col_labels:
             st.info("Select defects (if any) and click Submit.")
 
-            # Optionen und Default
-            options_list = list(CLASSES.values())
-
-            # Dictionary für Checkbox-Werte
-            label_choices = {}
-
-            for i, label in enumerate(options_list):
-                # Erster Wert standardmäßig ausgewählt
-                # default_checked = True if i == 0 else False
-                checkbox_key = f"{img_path}_checkbox_{i}"
-
-                label_choices[label] = st.checkbox(label, key=checkbox_key)
+            selected_labels = st.multiselect(
+                "Defects", options=list(CLASSES.values()), key=f"sel_{img_path}"
+            )
 
-            # Ausgewählte Labels filtern
-            selected_labels = [
-                label for label, checked in label_choices.items() if checked
-            ]
-
-            # current_class = [k for k, v in CLASSES.items() if v == label_choice][0]
+            # current_class = REVERSE_CLASSES[label_choice]
             # st.caption(CLASS_EXPLANATIONS[current_class])
 
             button_label = "✅ Submit"
@@ -264,15 +441,16 @@ if st.session_state.user:
                     REVERSE_CLASSES[choice] for choice in selected_labels
                 ]
                 save_label_bg(st.session_state.user, img_path, selected_labels)
-                st.session_state.current_image = select_random_image(
-                    get_unlabeled_images(all_images)
-                )
+                st.session_state.submitted.add(img_path)
+                st.session_state.current_image = st.session_state.next_image
+                st.session_state.next_image = None
                 # st.success("Saved!")
+                # Ganze Seite neu laden, damit auch die Begrüßung mit Rang
+                # aktualisiert wird
                 st.rerun()
 
         # --- Progress bars ---
-        user_count_once = get_count(1)
-        user_count_twice = get_count(2)
+        user_count_once, user_count_twice = progress_counts()
         total_images = len(all_images)
 
         st.progress(min(user_count_once / total_images, 1.0))
@@ -284,5 +462,12 @@ if st.session_state.user:
         # st.caption(f"{user_count_twice} of {total_images} images labeled by at least 2 users")
 
         if st.button("🔄 Skip image"):
-            st.session_state.current_image = select_random_image(unlabeled)
-            st.rerun()
+            st.session_state.current_image = st.session_state.next_image
+            st.session_state.next_image = None
+            st.rerun(scope="fragment")
+
+
+if st.session_state.user:
+    if "all_images" not in st.session_state:
+        st.session_state.all_images = load_images_list()
+    labeling_panel(st.session_state.all_images)
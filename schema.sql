@@ -0,0 +1,37 @@
+-- Supabase schema additions for the labeling app.
+-- Run in the Supabase SQL editor; every statement is safe to re-run.
+
+-- Number of distinct users per image, aggregated server-side so the app
+-- only has to download one row per labeled image.
+create or replace view label_counts as
+select image, count(distinct "user") as n
+from labels
+group by image;
+
+-- Covers the distinct-user count behind label_counts.
+create index if not exists labels_image_user_idx on labels (image, "user");
+
+-- Number of labels per user, used by user_rank().
+create or replace view user_label_counts as
+select "user", count(*) as n
+from labels
+group by "user";
+
+-- Insert time is set by Postgres; the app no longer sends it.
+alter table labels
+    alter column "timestamp" type timestamptz using "timestamp"::timestamptz,
+    alter column "timestamp" set default now();
+
+-- Label count and rank of a single user, so the app does not need the
+-- counts of all users to show one rank.
+create or replace function user_rank(uname text)
+returns table (total bigint, rnk bigint)
+language sql stable
+as $$
+    select n, rk
+    from (
+        select "user", n, rank() over (order by n desc) as rk
+        from user_label_counts
+    ) ranked
+    where "user" = uname;
+$$;